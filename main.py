@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 import asyncio
+from aiolimiter import AsyncLimiter
 from asyncinotify import Inotify, Mask
+from collections import defaultdict
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader, Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 from markdown import markdown
 from nio import AsyncClient
 from mypy_extensions import TypedDict
-from typing import List, NamedTuple, Optional, Tuple, Union
-import json
+from typing import Any, Callable, DefaultDict, Dict, List, NamedTuple, Optional, Tuple, Union
+import hashlib
+import orjson
 import os
 import logging
 import traceback
@@ -23,33 +26,85 @@ TalksData = TypedDict("TalksData", {
     "date": str,
     "talks": List[Talk],
 })
-DateChanged = NamedTuple("DateChanged", (("new_date", str),))
-HostsChanged = NamedTuple("HostsChanged", (("old_hosts", List[str]), ("new_hosts", List[str])))  # not tracking individuals
-TalkAdded = NamedTuple("TalkAdded", (("new_talk", Talk),))
-TalkRemoved = NamedTuple("TalkRemoved", (("old_talk", Talk),))
-TalkChanged = NamedTuple("TalkChanged", (("old_talk", Talk), ("new_talk", Talk)))
+
+
+class DateChanged(NamedTuple):
+    new_date: str
+
+
+class HostsChanged(NamedTuple):  # not tracking individuals
+    old_hosts: List[str]
+    new_hosts: List[str]
+
+
+class TalkAdded(NamedTuple):
+    new_talk: Talk
+
+
+class TalkRemoved(NamedTuple):
+    old_talk: Talk
+
+
+class TalkChanged(NamedTuple):
+    old_talk: Talk
+    new_talk: Talk
+
+
 Change = Union[DateChanged, HostsChanged, TalkAdded, TalkRemoved, TalkChanged]
+MAX_BACKOFF = 300  # seconds
+DEBOUNCE = 0.5  # seconds
+MAX_DEBOUNCE = 5  # seconds
+
+global_limiter = AsyncLimiter(30, 1)
+room_limiters = defaultdict(lambda: AsyncLimiter(20, 60))  # type: DefaultDict[str, AsyncLimiter]
 
 
 async def fetch_new_data(new_data_file: Path, backoff: int = 5) -> TalksData:
-    try:
-        data = json.loads(new_data_file.read_text())
-        return data
-    except Exception as exc:
-        print("Failed to get data, retrying:")
-        traceback.print_exception(exc)
-        await asyncio.sleep(backoff)
-        return await fetch_new_data(new_data_file, backoff * 2)
+    _, data = await fetch_new_data_if_changed(new_data_file, None, backoff)
+    assert data
+    return data
+
 
+async def fetch_new_data_if_changed(new_data_file: Path, known_hash: Optional[bytes], backoff: int = 5) -> Tuple[bytes, Optional[TalksData]]:
+    """Like fetch_new_data, but don't parse the file if its hash is known_hash.
 
-async def watch_for_new_data(client: AsyncClient, room_ids: List[str], jinja_templ: Template, current_data_file: Path, new_data_file: Path) -> None:
+    Returns the hash of the file and the data (or None if unchanged)."""
+    while True:
+        try:
+            raw = new_data_file.read_bytes()
+            data_hash = hashlib.blake2b(raw, digest_size=16).digest()
+            if data_hash == known_hash:
+                return data_hash, None
+            data = orjson.loads(raw)
+            return data_hash, data
+        except Exception as exc:
+            print("Failed to get data, retrying:")
+            traceback.print_exception(exc)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+async def watch_for_new_data(client: AsyncClient, room_ids: List[str], jinja_templ: Optional[Template], current_data_file: Path, new_data_file: Path) -> None:
     inotify = Inotify()
-    inotify.add_watch(str(new_data_file), Mask.CLOSE)
+    # only writes, our own reads would trigger CLOSE_NOWRITE
+    inotify.add_watch(str(new_data_file), Mask.CLOSE_WRITE)
+    loop = asyncio.get_running_loop()
     async for event in inotify:
+        # editors and sync tools tend to write several times in a row,
+        # so wait until things have settled down (but not forever)
+        deadline = loop.time() + MAX_DEBOUNCE
+        while True:
+            timeout = min(DEBOUNCE, deadline - loop.time())
+            if timeout <= 0:
+                break
+            try:
+                await asyncio.wait_for(inotify.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
         await got_new_data(client, room_ids, jinja_templ, current_data_file, new_data_file)
 
 
-async def _poll(client: AsyncClient, room_ids: List[str], jinja_templ: Template, current_data_file: Path, new_data_file: Path) -> None:
+async def _poll(client: AsyncClient, room_ids: List[str], jinja_templ: Optional[Template], current_data_file: Path, new_data_file: Path) -> None:
     from time import sleep
     while True:  # TODO
         sleep(60)
@@ -57,65 +112,130 @@ async def _poll(client: AsyncClient, room_ids: List[str], jinja_templ: Template,
 
 
 def save_current_data(current_data: TalksData, current_data_file: Path) -> None:
-    current_data_file.write_text(json.dumps(current_data))
+    # write to a temporary file first, so we never leave a half-written file behind
+    tmp_file = current_data_file.with_suffix(".json.tmp")
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+    with os.fdopen(fd, "wb") as f:  # writes everything, unlike a bare os.write
+        f.write(orjson.dumps(current_data, option=orjson.OPT_APPEND_NEWLINE))
+        f.flush()
+        os.fsync(fd)
+    os.replace(tmp_file, current_data_file)
 
 
-async def got_new_data(client: AsyncClient, room_ids: List[str], jinja_templ: Template, current_data_file: Path, new_data_file: Path) -> None:
-    global current_data
-    new_data = await fetch_new_data(new_data_file)
+async def got_new_data(client: AsyncClient, room_ids: List[str], jinja_templ: Optional[Template], current_data_file: Path, new_data_file: Path) -> None:
+    global current_data, current_data_hash, current_data_index
+    new_data_hash, new_data = await fetch_new_data_if_changed(new_data_file, current_data_hash)
+    if new_data is None:
+        logging.debug("File was rewritten, but nothing changed.")
+        return
     logging.debug("Got new data: %s", new_data)
-    changes = compare_data(current_data, new_data)
-    logging.debug("Computed changes: %s", changes)
-    await publish_changes(client, room_ids, jinja_templ, changes)
+    if new_data == current_data:
+        logging.debug("File was reformatted, but nothing changed.")
+        current_data_hash = new_data_hash
+        return
+    new_data_index = index_talks(new_data["talks"])
+    if current_data["date"] != new_data["date"]:  # next week, no need to compare stuff
+        await publish_full_schedule(client, room_ids, jinja_templ, new_data)
+    else:
+        changes = compare_data(current_data, new_data, current_data_index, new_data_index)
+        logging.debug("Computed changes: %s", changes)
+        await publish_changes(client, room_ids, jinja_templ, changes)
     logging.debug("Published.")
     current_data = new_data
+    current_data_hash = new_data_hash
+    current_data_index = new_data_index
     save_current_data(current_data, current_data_file)
 
 
-def compare_data(old: TalksData, new: TalksData) -> List[Change]:
+def compare_data(
+    old: TalksData,
+    new: TalksData,
+    old_by_title: Optional[Dict[str, Talk]] = None,
+    new_by_title: Optional[Dict[str, Talk]] = None,
+) -> List[Change]:
+    """Compute the changes from old to new.
+
+    old_by_title and new_by_title may be passed if the indexes of the talks are already known."""
+    if old == new:
+        return list()
     changes = list()  # type: List[Change]
     if old["date"] != new["date"]:  # next week, no need to compare stuff
-        if new["talks"] or new["hosts"] != ["fixme"]:
-            changes.append(DateChanged(new["date"]))
-            changes.append(HostsChanged(list(), new["hosts"]))
-            changes += [TalkAdded(talk) for talk in new["talks"]]
-        return changes
+        return full_schedule_changes(new)
     if old["hosts"] != new["hosts"]:
         changes.append(HostsChanged(old["hosts"], new["hosts"]))
+    if new_by_title is None:
+        new_by_title = index_talks(new["talks"])
+    if old_by_title is None:
+        old_by_title = index_talks(old["talks"])
     for talk in old["talks"]:
-        matching_talk = find_matching_talk(talk, new["talks"])
+        matching_talk = find_matching_talk(talk, new_by_title)
         if not matching_talk:
             changes.append(TalkRemoved(talk))
         else:
             if talk != matching_talk:
                 changes.append(TalkChanged(talk, matching_talk))
     for talk in new["talks"]:
-        matching_talk = find_matching_talk(talk, old["talks"])
+        matching_talk = find_matching_talk(talk, old_by_title)
         if not matching_talk:
             changes.append(TalkAdded(talk))
         # no need to track modified talks here, see above
     return changes
 
 
-def find_matching_talk(original_talk: Talk, list_of_talks: List[Talk]) -> Optional[Talk]:
-    """Find a talk in list_of_talks that matches original_talk."""
-    # TODO: improve
-    for possibility in list_of_talks:
+def full_schedule_changes(new: TalksData) -> List[Change]:
+    """Describe a new week as changes (if anything is planned yet)."""
+    if is_empty_week(new):
+        return list()
+    changes = list()  # type: List[Change]
+    changes.append(DateChanged(new["date"]))
+    changes.append(HostsChanged(list(), new["hosts"]))
+    changes += [TalkAdded(talk) for talk in new["talks"]]
+    return changes
+
+
+def is_empty_week(data: TalksData) -> bool:
+    """Whether nothing has been planned for this week yet."""
+    return not data["talks"] and data["hosts"] == ["fixme"]
+
+
+def index_talks(list_of_talks: List[Talk]) -> Dict[str, Talk]:
+    """Map the titles of list_of_talks to the talks themselves."""
+    index = dict()  # type: Dict[str, Talk]
+    for talk in list_of_talks:
+        index.setdefault(talk["title"], talk)  # first one wins, like before
+    return index
+
+
+def find_matching_talk(original_talk: Talk, talks: Union[List[Talk], Dict[str, Talk]]) -> Optional[Talk]:
+    """Find a talk in talks (a list or an index by title) that matches original_talk."""
+    if isinstance(talks, dict):
+        return talks.get(original_talk["title"])
+    for possibility in talks:
         if original_talk["title"] == possibility["title"]:
             return possibility
     return None
 
 
-async def publish_changes(client: AsyncClient, room_ids: List[str], jinja_templ: Template, changes: List[Change]) -> None:
+async def publish_changes(client: AsyncClient, room_ids: List[str], jinja_templ: Optional[Template], changes: List[Change]) -> None:
     if not changes:
         return
-    date_changed = tuple(filter(lambda x: isinstance(x, DateChanged), changes))  # type: Tuple[DateChanged, ...]
-    hosts_changed = tuple(filter(lambda x: isinstance(x, HostsChanged), changes))  # type: Tuple[HostsChanged, ...]
-    talks_added = tuple(filter(lambda x: isinstance(x, TalkAdded), changes))  # type: Tuple[TalkAdded, ...]
-    talks_changed = tuple(filter(lambda x: isinstance(x, TalkChanged), changes))  # type: Tuple[TalkChanged, ...]
-    talks_removed = tuple(filter(lambda x: isinstance(x, TalkRemoved), changes))  # type: Tuple[TalkRemoved, ...]
+    date_changed = list()  # type: List[DateChanged]
+    hosts_changed = list()  # type: List[HostsChanged]
+    talks_added = list()  # type: List[TalkAdded]
+    talks_changed = list()  # type: List[TalkChanged]
+    talks_removed = list()  # type: List[TalkRemoved]
+    buckets = {
+        DateChanged: date_changed.append,
+        HostsChanged: hosts_changed.append,
+        TalkAdded: talks_added.append,
+        TalkChanged: talks_changed.append,
+        TalkRemoved: talks_removed.append,
+    }  # type: Dict[type, Callable[[Any], None]]
+    for change in changes:
+        buckets[type(change)](change)
     date = date_changed[0].new_date if date_changed else current_data["date"]
-    output_md = jinja_templ.render(
+    render = jinja_templ.render if jinja_templ else render_message
+    output_md = render(
         date=date,
         date_changed=date_changed,
         talks_added=talks_added,
@@ -123,22 +243,105 @@ async def publish_changes(client: AsyncClient, room_ids: List[str], jinja_templ:
         talks_removed=talks_removed,
         hosts_changed=hosts_changed,
     )
-    print(output_md)
-    for room_id in room_ids:
+    await send_to_rooms(client, room_ids, output_md)
+
+
+async def publish_full_schedule(client: AsyncClient, room_ids: List[str], jinja_templ: Optional[Template], new: TalksData) -> None:
+    """Publish all talks of a new week (without computing changes first)."""
+    if jinja_templ:  # the template only knows how to render changes
+        await publish_changes(client, room_ids, jinja_templ, full_schedule_changes(new))
+    elif not is_empty_week(new):
+        await send_to_rooms(client, room_ids, render_full_schedule(new))
+
+
+async def send_to_rooms(client: AsyncClient, room_ids: List[str], output_md: str) -> None:
+    logging.debug("Sending: %s", output_md)
+    content = {
+        "msgtype": "m.text",
+        "format": "org.matrix.custom.html",
+        "body": output_md,
+        "formatted_body": markdown(output_md),
+    }
+    await asyncio.gather(*(
+        send_message(client, room_id, content)
+        for room_id in room_ids
+    ))
+
+
+def render_message(
+    date: str,
+    date_changed: List[DateChanged],
+    talks_added: List[TalkAdded],
+    talks_changed: List[TalkChanged],
+    talks_removed: List[TalkRemoved],
+    hosts_changed: List[HostsChanged],
+) -> str:
+    """Render the message for some changes, exactly like template.j2."""
+    return _render(
+        date,
+        bool(date_changed),
+        [talk_added.new_talk for talk_added in talks_added],
+        [talk_changed.new_talk for talk_changed in talks_changed],
+        [talk_removed.old_talk for talk_removed in talks_removed],
+        hosts_changed[0] if hosts_changed else None,
+    )
+
+
+def render_full_schedule(new: TalksData) -> str:
+    """Render the message for a new week, like render_message would for full_schedule_changes."""
+    return _render(new["date"], True, new["talks"], list(), list(), (list(), new["hosts"]))
+
+
+def _render(
+    date: str,
+    date_changed: bool,
+    talks_added: List[Talk],
+    talks_changed: List[Talk],
+    talks_removed: List[Talk],
+    hosts_changed: Optional[Tuple[List[str], List[str]]],
+) -> str:
+    parts = list()  # type: List[str]
+    if date_changed:
+        parts.append(f"*Talks on {date}*:\n\n")
+    else:
+        parts.append(f"*Changes to talks on {date}*:\n\n")
+    if talks_added:
+        parts.append("Talks added:\n")
+        parts += [_format_talk(talk) for talk in talks_added]
+        parts.append("\n")
+    if talks_changed:
+        parts.append("Talks changed:\n")
+        parts += [_format_talk(talk) for talk in talks_changed]
+        parts.append("\n")
+    if talks_removed:
+        parts.append("Talks removed:\n")
+        parts += [_format_talk(talk) for talk in talks_removed]
+        parts.append("\n")
+    if hosts_changed:
+        old_hosts, new_hosts = (", ".join(hosts) for hosts in hosts_changed)
+        parts.append(f"New hosts: {new_hosts} (instead of {old_hosts})\n\n")
+    parts.append(f"See the wiki for more details: https://wiki.chaosdorf.de/Freitagsfoo/{date}")
+    return "".join(parts)
+
+
+def _format_talk(talk: Talk) -> str:
+    persons = ", ".join(talk["persons"])
+    return f"{talk['title']} ({persons})\n{talk['description']}\n\n"
+
+
+async def send_message(client: AsyncClient, room_id: str, content: Dict[str, str]) -> None:
+    """Send a message to a room, staying within the rate limits."""
+    # wait for the room first, so we don't use up global capacity while blocked on it
+    async with room_limiters[room_id], global_limiter:
         await client.room_send(
             room_id=room_id,
             message_type="m.room.message",
-            content={
-                "msgtype": "m.text",
-                "format": "org.matrix.custom.html",
-                "body": output_md,
-                "formatted_body": markdown(output_md),
-            },
+            content=content,
         )
 
 
 async def main():
-    global current_data
+    global current_data, current_data_hash, current_data_index
     if os.environ.get("LOGLEVEL"):
         logging.basicConfig(level=getattr(logging, os.environ["LOGLEVEL"].upper()))
     
@@ -146,22 +349,27 @@ async def main():
     current_data_file = data_path / Path("current.json")
     new_data_file = Path(os.environ.get("NEW_DATA_FILE", "new.json"))
     current_data = None
+    current_data_hash = None
     
     try:
-        current_data = json.loads(current_data_file.read_text())
+        current_data = orjson.loads(current_data_file.read_bytes())
     except:
         logging.warn("Failed to load old data")
         current_data = await fetch_new_data(new_data_file)
         save_current_data(current_data, current_data_file)
     
     assert current_data
+    current_data_index = index_talks(current_data["talks"])
     
-    jinja_env = Environment(
-        loader=FileSystemLoader("."),
-        trim_blocks=True,
-        lstrip_blocks=True,
-    )
-    jinja_templ = jinja_env.get_template("template.j2")
+    jinja_templ = None
+    if os.environ.get("USE_JINJA"):  # otherwise, use the (faster) render_message
+        jinja_env = Environment(
+            loader=FileSystemLoader("."),
+            bytecode_cache=FileSystemBytecodeCache(),  # don't recompile the template on every restart
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        jinja_templ = jinja_env.get_template("template.j2")
     client = AsyncClient(os.environ["MATRIX_HOMESERVER"], os.environ["MATRIX_USERNAME"])
     room_ids = os.environ["MATRIX_ROOM_IDS"].split(",")
     logging.info(await client.login(os.environ["MATRIX_PASSWORD"]))